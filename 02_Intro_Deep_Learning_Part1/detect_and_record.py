@@ -2,10 +2,12 @@
 # Copyright 2020 Deepwave Digital Inc.
 import sys
 import argparse
-from SoapySDR import Device, SOAPY_SDR_RX, SOAPY_SDR_CF32, SOAPY_SDR_OVERFLOW
 import cusignal
 import cupy as cp
 from powerdetector import PowerDetector, PowerDetectorPlot, PowerDetectorWriter
+from pipeline import BufferRing, Pipeline, SourceStage, DetectorStage, ResamplerStage, \
+    WriterStage, SOAPY_SDR_RX, SOAPY_SDR_CF32
+from scan import ScanSourceStage, SimulatedDevice, parse_scan_plan
 
 
 def parse_command_line_arguments():
@@ -31,6 +33,19 @@ def parse_command_line_arguments():
                         help='Buffer size for reading from receiver')
     parser.add_argument('-d', type=int, required=False, dest='dec', default=32,
                         help='Integer decimation factor for power signal')
+    parser.add_argument('-k', type=int, required=False, dest='num_buffs', default=4,
+                        help='Number of receive buffers in the ring')
+    parser.add_argument('-r', type=int, nargs=2, required=False, dest='resample',
+                        default=None, metavar=('UP', 'DOWN'),
+                        help='Resample detected segments by UP/DOWN before writing')
+    parser.add_argument('-S', type=str, nargs='+', required=False, dest='scan',
+                        default=None, metavar='FREQ:DWELL',
+                        help='Scan center frequencies in Hz, dwelling DWELL seconds on '
+                             'each, instead of staying on -f')
+    parser.add_argument('-w', type=int, required=False, dest='settle_len', default=8192,
+                        help='Number of samples to discard after each retune in scan mode')
+    parser.add_argument('-e', action='store_true', required=False, dest='simulate',
+                        help='Use a simulated radio with signals at the scan frequencies')
     parser.add_argument('-v', action='store_true', required=False, dest='visualization',
                         help='Flag show plots when signal detected')
     parser.add_argument('-p', type=str, required=False, dest='output_path',
@@ -42,7 +57,15 @@ def main():
     pars = parse_command_line_arguments()
 
     #  Initialize the AIR-T receiver, set sample rate, gain, and frequency
-    sdr = Device()
+    if pars.scan is not None:
+        plan = parse_scan_plan(pars.scan, pars.samp_rate, pars.buff_len)
+    else:
+        plan = [(pars.freq, 1)]
+    if pars.simulate:
+        sdr = SimulatedDevice({freq: -20 for freq, _ in plan})
+    else:
+        from SoapySDR import Device  # Only needed with the real radio
+        sdr = Device()
     sdr.setSampleRate(SOAPY_SDR_RX, pars.channel, pars.samp_rate)
     if pars.gain == 'agc':
         sdr.setGainMode(SOAPY_SDR_RX, pars.channel, True)  # Set AGC
@@ -50,35 +73,50 @@ def main():
         sdr.setGain(SOAPY_SDR_RX, pars.channel, float(pars.gain))  # set manual gain
     sdr.setFrequency(SOAPY_SDR_RX, pars.channel, pars.freq)
 
-    # Create SDR shared memory buffer, detector, file writer, and plotter (if desired)
-    buff = cusignal.get_shared_mem(pars.buff_len, dtype=cp.complex64)
-    detr = PowerDetector(buff, pars.seg_len, pars.dec, pars.threshold)
+    # Create ring of SDR shared memory buffers, detector, file writer, and plotter
+    # (if desired)
+    alloc = lambda n: cusignal.get_shared_mem(n, dtype=cp.complex64)
+    ring = BufferRing(pars.num_buffs, pars.buff_len, alloc)
+    detr = PowerDetector(ring.buffers[0], pars.seg_len, pars.dec, pars.threshold)
     writer = PowerDetectorWriter(pars.output_path, pars.label, pars.num_files)
+    plotter = None
     if pars.visualization:
         plotter = PowerDetectorPlot(pars.buff_len, pars.dec, pars.samp_rate,
-                                              pars.seg_len, pars.threshold)
+                                    pars.seg_len, pars.threshold)
 
     # Turn on radio
     rx_stream = sdr.setupStream(SOAPY_SDR_RX, SOAPY_SDR_CF32, [pars.channel])
     sdr.activateStream(rx_stream)
+
+    # Read into buffer k+1 while buffer k is being processed
+    if pars.scan is not None:  # Retune between bands, reusing stream and detector
+        source = ScanSourceStage(sdr, rx_stream, pars.channel, plan, pars.settle_len)
+    else:
+        source = SourceStage(sdr, rx_stream)
+    stages = [source, DetectorStage(detr, pars.visualization)]
+    if pars.resample is not None:
+        stages.append(ResamplerStage(pars.seg_len, *pars.resample))
+    stages.append(WriterStage(writer, plotter))
+    pipe = Pipeline(ring, stages)
     print('Looking for signals to record. Press ctrl-c to exit.')
-    
-    while True:  # Start processing Data
-        try:
-            sr = sdr.readStream(rx_stream, [buff], pars.buff_len)  # Read data to buffer
-            if sr.ret == SOAPY_SDR_OVERFLOW:  # Data was dropped, i.e., overflow
-                print('O', end='', flush=True)
-            else:
-                det_signal = detr.detect(buff)
-                writer.tofile(det_signal)
-                if pars.visualization:  # Displays the detected data if desired
-                    plotter.update(cp.asnumpy(buff), detr.det_index, detr.amp_sq)
-        except KeyboardInterrupt:
-            sdr.deactivateStream(rx_stream)
-            sdr.closeStream(rx_stream)
-            break
+
+    try:  # Start processing Data
+        pipe.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sdr.deactivateStream(rx_stream)
+        sdr.closeStream(rx_stream)
+    print()
+    for stage in pipe.stats()['stages']:
+        print('{name}: {frames_in} frames in, {frames_out} frames out, '
+              'max queue depth {max_depth}'.format(**stage))
+        if 'bands' in stage:
+            print('Scan throughput = {:1.2f} MSPS'.format(stage['throughput_msps']))
+            for band in stage['bands']:
+                print('{freq:.0f} Hz: {visits} visits, {frames} frames, '
+                      '{revisit_rate:1.2f} revisits/s'.format(**band))
 
 
 if __name__ == '__main__':
     main()
-
@@ -0,0 +1,521 @@
+# Copyright 2020 Deepwave Digital Inc.
+import queue
+import asyncio
+import threading
+import numpy as np
+import cupy as cp
+import cusignal
+try:
+    from SoapySDR import SOAPY_SDR_RX, SOAPY_SDR_CF32, SOAPY_SDR_OVERFLOW
+except ImportError:  # Values from SoapySDR, so SimulatedDevice runs without it
+    SOAPY_SDR_RX = 1
+    SOAPY_SDR_CF32 = 'CF32'
+    SOAPY_SDR_OVERFLOW = -4
+
+_STOP = object()  # Sentinel passed down the pipeline at shutdown
+
+
+class Frame:
+    """ One slot of a BufferRing
+
+    A frame owns its sample buffer for the lifetime of the ring. Stages attach
+    their results to the frame as it travels down the pipeline and the last
+    stage hands it back to the ring to be refilled.
+
+    Parameters
+    ----------
+    index : int
+        position of the frame in the ring
+    buff : array_like
+        preallocated sample buffer owned by this frame
+    """
+
+    def __init__(self, index, buff):
+        self.index = index
+        self.buff = buff
+        self.num_samps = 0
+        self.data = None
+        self.meta = {}
+
+    def reset(self):
+        """ Clear the per-transfer state so the frame can be reused """
+        self.num_samps = 0
+        self.data = None
+        self.meta.clear()
+
+
+class BufferRing:
+    """ Preallocated ring of reusable sample buffers
+
+    Buffers are allocated once and recycled: the source acquires a free frame,
+    fills it, and the frame is released back to the ring after the last stage
+    is done with it. When every frame is in flight the source blocks, which
+    provides backpressure instead of allocating more memory.
+
+    Parameters
+    ----------
+    num_buffs : int
+        number of buffers in the ring, i.e., the number of transfers that may
+        be in flight at once
+    buff_len : int
+        number of complex samples per buffer
+    alloc : callable, optional
+        function taking buff_len and returning a new buffer. Defaults to a
+        complex64 numpy array. Use cusignal.get_shared_mem on the AIR-T so the
+        GPU can read the buffers without a copy.
+
+    Examples
+    --------
+    >>> alloc = lambda n: cusignal.get_shared_mem(n, dtype=cp.complex64)
+    >>> ring = BufferRing(4, 2**16, alloc)
+    >>> frame = ring.acquire()
+    >>> sr = sdr.readStream(rx_stream, [frame.buff], len(frame.buff))
+    >>> ring.release(frame)
+    """
+
+    def __init__(self, num_buffs, buff_len, alloc=None):
+        assert num_buffs >= 2, 'BufferRing needs at least two buffers to overlap I/O'
+        if alloc is None:
+            alloc = lambda n: np.empty(n, dtype=np.complex64)
+        self._frames = [Frame(i, alloc(buff_len)) for i in range(num_buffs)]
+        self._free = queue.Queue()
+        for frame in self._frames:
+            self._free.put(frame)
+        self._min_free = num_buffs
+
+    def acquire(self, timeout=None):
+        """ Take a free frame from the ring
+
+        Parameters
+        ----------
+        timeout : float, optional
+            seconds to wait for a free frame. Blocks forever if None.
+
+        Returns
+        -------
+        frame : Frame
+            a frame whose buffer may be overwritten
+
+        Raises
+        ------
+        queue.Empty
+            if no frame was released within timeout
+        """
+        frame = self._free.get(timeout=timeout)
+        self._min_free = min(self._min_free, self._free.qsize())
+        return frame
+
+    def release(self, frame):
+        """ Return a frame to the ring so its buffer can be refilled """
+        assert self._frames[frame.index] is frame, 'frame does not belong to this ring'
+        frame.reset()
+        self._free.put(frame)
+
+    @property
+    def buffers(self):
+        """ List of all buffers in the ring """
+        return [frame.buff for frame in self._frames]
+
+    @property
+    def num_buffs(self):
+        """ Total number of buffers in the ring """
+        return len(self._frames)
+
+    @property
+    def num_free(self):
+        """ Number of buffers currently available to the source """
+        return self._free.qsize()
+
+    @property
+    def min_free(self):
+        """ Fewest free buffers seen by the source. 0 means the ring ran dry """
+        return self._min_free
+
+
+class Stage:
+    """ Base class for a pipeline stage
+
+    Each stage pulls frames from its input queue, calls process(), and passes
+    the result to the next stage. Subclasses implement process(), returning the
+    frame to forward it or None to drop it (the frame is then released back to
+    the ring). Stages are wired together and started by Pipeline.
+
+    Parameters
+    ----------
+    name : str
+        name used when reporting statistics
+    depth : int, optional
+        maximum number of frames waiting in the input queue of this stage
+    """
+
+    def __init__(self, name, depth=2):
+        self.name = name
+        self.in_q = queue.Queue(maxsize=depth)
+        self.frames_in = 0  # Number of frames received
+        self.frames_out = 0  # Number of frames passed to the next stage
+        self.max_depth = 0  # Deepest input queue seen
+        self.error = None
+        self._next = None
+        self._ring = None
+        self._stop = None
+        self._done = False
+
+    def process(self, frame):
+        """ Process a frame
+
+        Parameters
+        ----------
+        frame : Frame
+            frame received from the previous stage
+
+        Returns
+        -------
+        frame : Frame or None
+            frame to pass to the next stage, or None to drop it
+        """
+        raise NotImplementedError
+
+    def run(self):
+        """ Process frames until the stop sentinel is received
+
+        If process() raises, the error is saved, the pipeline is asked to stop,
+        and the stage keeps draining its queue so upstream stages never block.
+        """
+        while not self._done:
+            frame = self.in_q.get()
+            if frame is _STOP:
+                self._done = True
+                self._emit(_STOP)
+                break
+            if self.error is not None:  # Failed earlier, just recycle frames
+                self._ring.release(frame)
+                continue
+            self.frames_in += 1
+            try:
+                out = self.process(frame)
+            except (Exception, SystemExit) as err:
+                self.error = err
+                self._stop.set()
+                out = None
+            if out is None:
+                self._ring.release(frame)
+            else:
+                self.frames_out += 1
+                self._emit(out)
+
+    def drain(self):
+        """ Release queued frames until the stop sentinel is received """
+        while not self._done:
+            frame = self.in_q.get()
+            if frame is _STOP:
+                self._done = True
+                self._emit(_STOP)
+            else:
+                self._ring.release(frame)
+
+    def stats(self):
+        """ Stage statistics
+
+        Returns
+        -------
+        dict : name, frames received and passed on, current and maximum input
+            queue depth
+        """
+        depth = 0 if self.in_q is None else self.in_q.qsize()
+        return {'name': self.name, 'frames_in': self.frames_in,
+                'frames_out': self.frames_out, 'queue_depth': depth,
+                'max_depth': self.max_depth}
+
+    def _emit(self, frame):
+        """ Pass a frame to the next stage, or back to the ring if last """
+        if self._next is not None:
+            self._next.in_q.put(frame)
+            self._next.max_depth = max(self._next.max_depth, self._next.in_q.qsize())
+        elif frame is not _STOP:
+            self._ring.release(frame)
+
+
+class SourceStage(Stage):
+    """ Reads samples from a SoapySDR stream into buffers from the ring
+
+    Parameters
+    ----------
+    sdr : SoapySDR.Device
+        radio to read from
+    rx_stream : SoapySDR.Stream
+        activated receive stream
+    name : str, optional
+        name used when reporting statistics
+    """
+
+    def __init__(self, sdr, rx_stream, name='source'):
+        super().__init__(name)
+        self.in_q = None
+        self.overflows = 0
+        self._sdr = sdr
+        self._rx_stream = rx_stream
+
+    def read(self, frame):
+        """ Fill the buffer of a frame from the radio
+
+        Parameters
+        ----------
+        frame : Frame
+            frame whose buffer will be overwritten
+
+        Short reads are repeated into the rest of the buffer until it is full,
+        so downstream stages never see samples left over from an older transfer.
+
+        Returns
+        -------
+        bool : True if the whole buffer holds new contiguous data
+        """
+        buff_len = len(frame.buff)
+        while frame.num_samps < buff_len:
+            sr = self._sdr.readStream(self._rx_stream, [frame.buff[frame.num_samps:]],
+                                      buff_len - frame.num_samps)
+            if sr.ret == SOAPY_SDR_OVERFLOW:  # Data was dropped, i.e., overflow
+                print('O', end='', flush=True)
+                self.overflows += 1
+                return False
+            if sr.ret < 0:  # Timeout or other stream error
+                return False
+            frame.num_samps += sr.ret
+        return True
+
+    def run(self):
+        """ Read frames until the pipeline is stopped """
+        while not self._stop.is_set():
+            try:
+                frame = self._ring.acquire(timeout=0.1)
+            except queue.Empty:  # All buffers in flight, check for stop and retry
+                continue
+            self.frames_in += 1
+            try:
+                valid = self.read(frame)
+            except Exception as err:
+                self.error = err
+                self._stop.set()
+                valid = False
+            if valid:
+                self.frames_out += 1
+                self._emit(frame)
+            else:
+                self._ring.release(frame)
+        self._done = True
+        self._emit(_STOP)
+
+    def drain(self):
+        pass
+
+
+class DetectorStage(Stage):
+    """ Runs a PowerDetector on each frame
+
+    Frames without detections are released immediately. The detected segments
+    are stored in frame.data.
+
+    Parameters
+    ----------
+    detector : PowerDetector
+        detector instance. Only this stage may call it.
+    keep_power : bool, optional
+        also copy the detection index and power signal to frame.meta, as
+        needed by PowerDetectorPlot
+    name : str, optional
+        name used when reporting statistics
+    """
+
+    def __init__(self, detector, keep_power=False, name='detector'):
+        super().__init__(name)
+        self._detector = detector
+        self._keep_power = keep_power
+
+    def process(self, frame):
+        frame.data = self._detector.detect(frame.buff)
+        if len(frame.data) == 0:
+            return None
+        if self._keep_power:
+            frame.meta['det_index'] = self._detector.det_index
+            frame.meta['amp_sq'] = self._detector.amp_sq
+        return frame
+
+
+class ResamplerStage(Stage):
+    """ Polyphase resampling of the detected segments in frame.data
+
+    Parameters
+    ----------
+    seg_len : int
+        length of the detected segments, used to compile the CUDA kernels
+    up : int
+        upsampling factor
+    down : int
+        downsampling factor
+    name : str, optional
+        name used when reporting statistics
+    """
+
+    def __init__(self, seg_len, up, down, name='resampler'):
+        super().__init__(name)
+        self._up = up
+        self._down = down
+        fc = 1. / max(up, down)  # cutoff of FIR filter (rel. to Nyquist)
+        nc = 10 * max(up, down)  # reasonable cutoff for our sinc-like function
+        win = cusignal.fir_filter_design.firwin(2 * nc + 1, fc, window=('kaiser', 0.5))
+        self._win = cp.asarray(win, dtype=cp.float32)
+        self._resample(cp.zeros((1, seg_len), dtype=cp.complex64))  # Compile kernels
+
+    def _resample(self, x):
+        return cusignal.resample_poly(x, self._up, self._down, axis=1, window=self._win)
+
+    def process(self, frame):
+        frame.data = cp.asnumpy(self._resample(frame.data))
+        return frame
+
+
+class WriterStage(Stage):
+    """ Writes frame.data to disk and optionally updates the plot
+
+    Files are tagged with frame.meta['freq'] when the source sets it.
+
+    Parameters
+    ----------
+    writer : PowerDetectorWriter
+        file writer
+    plotter : PowerDetectorPlot, optional
+        plotter, requires DetectorStage(keep_power=True). Run this stage last
+        with Pipeline.run() so plotting happens in the main thread.
+    name : str, optional
+        name used when reporting statistics
+    """
+
+    def __init__(self, writer, plotter=None, name='writer'):
+        super().__init__(name)
+        self._writer = writer
+        self._plotter = plotter
+
+    def process(self, frame):
+        self._writer.tofile(frame.data, frame.meta.get('freq'))
+        if self._plotter is not None:
+            self._plotter.update(cp.asnumpy(frame.buff), frame.meta['det_index'],
+                                 frame.meta['amp_sq'])
+        return frame
+
+
+class Pipeline:
+    """ Threaded streaming pipeline connected by a BufferRing
+
+    The source fills buffer k+1 while downstream stages work on buffer k. Each
+    stage runs in its own thread and frames are passed through bounded queues,
+    so no sample data is copied or reallocated between stages.
+
+    Parameters
+    ----------
+    ring : BufferRing
+        preallocated buffers shared by all stages
+    stages : list of Stage
+        stages in processing order, starting with a SourceStage
+
+    Examples
+    --------
+    Blocking use, with the last stage in the calling thread:
+
+    >>> pipe = Pipeline(ring, [SourceStage(sdr, rx_stream), DetectorStage(detr),
+    >>>                        WriterStage(writer)])
+    >>> pipe.run()  # Returns when stopped or when the writer exits
+
+    From asyncio, e.g., alongside control and telemetry services:
+
+    >>> async with Pipeline(ring, stages) as pipe:
+    >>>     async for stats in pipe.telemetry(period=1.0):
+    >>>         publish(stats)  # Your function
+    """
+
+    def __init__(self, ring, stages):
+        self._ring = ring
+        self._stages = list(stages)
+        self._stop = threading.Event()
+        self._threads = []
+        for stage, nxt in zip(self._stages, self._stages[1:] + [None]):
+            stage._next = nxt
+            stage._ring = ring
+            stage._stop = self._stop
+
+    def start(self):
+        """ Start every stage in a background thread """
+        self._start(self._stages)
+
+    def run(self):
+        """ Run the pipeline, processing the last stage in the calling thread
+
+        Returns when the pipeline is stopped or a stage fails. Errors raised by
+        a stage are re-raised here, except SystemExit which ends the pipeline
+        normally.
+        """
+        self._start(self._stages[:-1])
+        try:
+            self._stages[-1].run()
+        finally:
+            self.stop()
+            self._stages[-1].drain()
+            self.join()
+        self._raise_stage_error()
+
+    def stop(self):
+        """ Ask the source to stop. Queued frames are drained by the stages """
+        self._stop.set()
+
+    def join(self, timeout=None):
+        """ Wait for all stage threads to finish """
+        for thread in self._threads:
+            thread.join(timeout)
+
+    @property
+    def is_running(self):
+        """ True while any stage thread is alive """
+        return any(thread.is_alive() for thread in self._threads)
+
+    def stats(self):
+        """ Pipeline statistics
+
+        Returns
+        -------
+        dict : free and minimum free buffers in the ring and per-stage statistics
+        """
+        return {'ring_free': self._ring.num_free, 'ring_min_free': self._ring.min_free,
+                'stages': [stage.stats() for stage in self._stages]}
+
+    async def wait_closed(self):
+        """ Wait for all stage threads to finish without blocking the event loop """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.join)
+
+    async def telemetry(self, period=1.0):
+        """ Yield pipeline statistics every period seconds while running """
+        while self.is_running:
+            yield self.stats()
+            await asyncio.sleep(period)
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.stop()
+        await self.wait_closed()
+        if exc_type is None:
+            self._raise_stage_error()
+
+    def _raise_stage_error(self):
+        """ Re-raise the first stage error, except SystemExit which ends normally """
+        for stage in self._stages:
+            if stage.error is not None and not isinstance(stage.error, SystemExit):
+                raise stage.error
+
+    def _start(self, stages):
+        self._stop.clear()
+        for stage in stages:
+            thread = threading.Thread(target=stage.run, name=stage.name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
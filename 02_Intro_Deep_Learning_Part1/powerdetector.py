@@ -315,17 +315,22 @@ class PowerDetectorWriter:
             self._ctr = 0
             os.makedirs(self._output_path, exist_ok=True)
     
-    def tofile(self, signal_matrix):
+    def tofile(self, signal_matrix, freq=None):
         """ Write to disk
         
         Parameters
         ----------
         signal_matrix : array_like
             matrix of signal data to write to disk. Rows written to individual files
+        freq : float, optional
+            receiver tuning frequency in Hz, added to the file names if given
         """
         
         for i, sig in enumerate(signal_matrix):
-            filename = '{}_{:010.0f}.bin'.format(self._label, self._ctr)
+            if freq is None:
+                filename = '{}_{:010.0f}.bin'.format(self._label, self._ctr)
+            else:
+                filename = '{}_{:.0f}Hz_{:010.0f}.bin'.format(self._label, freq, self._ctr)
             sig.tofile(os.path.join(self._output_path, filename))
             self._ctr += 1
             if self._ctr >= self._num_files:
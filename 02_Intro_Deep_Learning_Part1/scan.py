@@ -0,0 +1,232 @@
+# Copyright 2020 Deepwave Digital Inc.
+import time
+import collections
+import numpy as np
+from pipeline import SourceStage, SOAPY_SDR_RX
+
+StreamResult = collections.namedtuple('StreamResult', ['ret', 'flags', 'timeNs'])
+
+
+def parse_scan_plan(bands, samp_rate, buff_len):
+    """ Converts FREQ:DWELL strings into a scan plan
+
+    Parameters
+    ----------
+    bands : list of str
+        center frequency in Hz and dwell time in seconds of each band, e.g.,
+        ['315e6:0.5', '433.92e6:0.25']
+    samp_rate : float
+        receiver sample rate
+    buff_len : int
+        number of samples per buffer
+
+    Returns
+    -------
+    plan : list of tuple
+        (frequency, number of buffers to read before retuning) for each band
+    """
+    plan = []
+    for band in bands:
+        freq, dwell = band.split(':')
+        num_buffs = max(1, int(round(float(dwell) * samp_rate / buff_len)))
+        plan.append((float(freq), num_buffs))
+    return plan
+
+
+class ScanSourceStage(SourceStage):
+    """ Source stage that steps the receiver through a list of frequencies
+
+    The same stream and downstream stages are used for every band. The stream
+    is deactivated while retuning, which flushes samples captured on the old
+    band from the driver. After it is reactivated, settle_len samples are read
+    into the frame buffer and discarded before the dwell starts. Every frame is
+    tagged with frame.meta['freq'].
+
+    Parameters
+    ----------
+    sdr : SoapySDR.Device
+        radio to read from
+    rx_stream : SoapySDR.Stream
+        activated receive stream
+    channel : int
+        receiver channel to tune
+    plan : list of tuple
+        (frequency, number of buffers per dwell) for each band, as returned
+        by parse_scan_plan
+    settle_len : int
+        number of samples to discard after each retune
+    name : str, optional
+        name used when reporting statistics
+    """
+
+    def __init__(self, sdr, rx_stream, channel, plan, settle_len, name='scan'):
+        super().__init__(sdr, rx_stream, name)
+        self._channel = channel
+        self._plan = plan
+        self._settle_len = settle_len
+        self._band = -1
+        self._dwell_left = 0
+        self._t0 = None
+        self._samps = 0  # Samples delivered downstream, excluding settling
+        self._visits = [0] * len(plan)
+        self._band_frames = [0] * len(plan)
+
+    def read(self, frame):
+        if self._t0 is None:
+            self._t0 = time.monotonic()
+        if self._dwell_left == 0:
+            self._retune(frame.buff)
+        if not super().read(frame):
+            return False
+        freq, _ = self._plan[self._band]
+        frame.meta['freq'] = freq
+        self._dwell_left -= 1
+        self._samps += frame.num_samps
+        self._band_frames[self._band] += 1
+        return True
+
+    def _retune(self, buff):
+        """ Tune to the next band and discard the settling samples into buff """
+        prev_band = self._band
+        prev_freq = None if prev_band < 0 else self._plan[prev_band][0]
+        self._band = (self._band + 1) % len(self._plan)
+        freq, self._dwell_left = self._plan[self._band]
+        if self._band != prev_band:
+            self._visits[self._band] += 1
+        if freq == prev_freq:  # Already tuned, e.g., a one band plan
+            return
+        self._sdr.deactivateStream(self._rx_stream)  # Flush old band samples
+        self._sdr.setFrequency(SOAPY_SDR_RX, self._channel, freq)
+        self._sdr.activateStream(self._rx_stream)
+        settle_left = self._settle_len
+        while settle_left > 0 and not self._stop.is_set():
+            n = min(settle_left, len(buff))
+            sr = self._sdr.readStream(self._rx_stream, [buff], n)
+            if sr.ret > 0:
+                settle_left -= sr.ret
+
+    def stats(self):
+        """ Stage statistics, with scan throughput and per-band revisit rate
+
+        Returns
+        -------
+        dict : Stage.stats() plus throughput_msps and, for each band, the
+            frequency, number of visits, frames read, and revisits per second
+        """
+        stats = super().stats()
+        elapsed = 0 if self._t0 is None else time.monotonic() - self._t0
+        stats['throughput_msps'] = self._samps / elapsed / 1e6 if elapsed else 0.
+        stats['bands'] = []
+        for (freq, _), visits, frames in zip(self._plan, self._visits,
+                                             self._band_frames):
+            revisits = max(visits - 1, 0)  # The first visit is not a revisit
+            stats['bands'].append({'freq': freq, 'visits': visits, 'frames': frames,
+                                   'revisit_rate': revisits / elapsed if elapsed else 0.})
+        return stats
+
+
+class SimulatedDevice:
+    """ Stand-in for SoapySDR.Device that generates noise and bursty tones
+
+    Implements the subset of the Device API used by detect_and_record. A tone is
+    present in a buffer when the receiver is tuned within half the sample rate
+    of one of the signal frequencies. The first settle_len samples after a
+    retune contain a large transient to mimic LO settling.
+
+    Like a driver, the device buffers latency samples that were captured before
+    readStream is called, so samples from the previous band are returned after
+    a retune unless the stream is deactivated to flush them.
+
+    Parameters
+    ----------
+    signals : dict
+        mapping of signal frequency in Hz to power in dB full scale
+    noise_db : float, optional
+        noise power in dB full scale
+    burst_prob : float, optional
+        probability that a signal is on during a given buffer
+    settle_len : int, optional
+        number of corrupted samples after each retune
+    latency : int, optional
+        number of captured samples buffered in the device
+    realtime : bool, optional
+        pace readStream to the configured sample rate
+
+    Examples
+    --------
+    >>> sdr = SimulatedDevice({315e6: -20, 433.92e6: -10})
+    >>> sdr.setSampleRate(SOAPY_SDR_RX, 0, 7.8128e6)
+    >>> rx_stream = sdr.setupStream(SOAPY_SDR_RX, SOAPY_SDR_CF32, [0])
+    >>> sdr.activateStream(rx_stream)
+    >>> sr = sdr.readStream(rx_stream, [buff], len(buff))
+    """
+
+    def __init__(self, signals, noise_db=-50, burst_prob=0.25, settle_len=4096,
+                 latency=65536, realtime=True):
+        self._signals = signals
+        self._noise_amp = 10 ** (noise_db / 20) / np.sqrt(2)
+        self._burst_prob = burst_prob
+        self._settle_len = settle_len
+        self._latency = latency
+        self._realtime = realtime
+        self._fifo = np.zeros(0, dtype=np.complex64)  # Captured, not yet read
+        self._samp_rate = 1e6
+        self._freq = 0.
+        self._settle_left = 0
+        self._n = 0  # Sample counter for tone phase and realtime pacing
+        self._t0 = None
+
+    def setSampleRate(self, direction, channel, rate):
+        self._samp_rate = rate
+
+    def setGainMode(self, direction, channel, automatic):
+        pass
+
+    def setGain(self, direction, channel, value):
+        pass
+
+    def setFrequency(self, direction, channel, frequency):
+        self._freq = frequency
+        self._settle_left = self._settle_len
+
+    def getFrequency(self, direction, channel):
+        return self._freq
+
+    def setupStream(self, direction, fmt, channels):
+        return object()
+
+    def activateStream(self, stream):
+        self._t0 = time.monotonic() - self._n / self._samp_rate
+        self._fifo = self._capture(self._latency)
+
+    def deactivateStream(self, stream):
+        self._fifo = self._fifo[:0]
+
+    def closeStream(self, stream):
+        pass
+
+    def readStream(self, stream, buffs, num_samps):
+        self._fifo = np.concatenate((self._fifo, self._capture(num_samps)))
+        buffs[0][:num_samps] = self._fifo[:num_samps]
+        self._fifo = self._fifo[num_samps:]
+        if self._realtime:
+            delay = self._t0 + self._n / self._samp_rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        return StreamResult(num_samps, 0, 0)
+
+    def _capture(self, num_samps):
+        """ Generate the next num_samps samples at the current tuning """
+        t = (self._n + np.arange(num_samps)) / self._samp_rate
+        sig = self._noise_amp * (np.random.randn(num_samps) +
+                                 1j * np.random.randn(num_samps))
+        for freq, power_db in self._signals.items():
+            offset = freq - self._freq
+            if abs(offset) < self._samp_rate / 2 and \
+                    np.random.rand() < self._burst_prob:
+                sig += 10 ** (power_db / 20) * np.exp(2j * np.pi * offset * t)
+        n_settle = min(self._settle_left, num_samps)
+        sig[:n_settle] = 1 + 1j  # Full scale transient while the LO settles
+        self._settle_left -= n_settle
+        self._n += num_samps
+        return sig.astype(np.complex64)